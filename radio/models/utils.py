@@ -100,12 +100,10 @@ def overlap_nodules(batch, nodules_true, nodules_pred):
     ----------
     batch : CTImagesMaskedBatch
         input batch
-    nodules_true : numpy record array
-        numpy record array of type CTImagesMaskedBatch.nodules_dtype
-        with true nodules.
-    nodules_pred : numpy record array
-        numpy record array of type CTImagesMaskedBatch.nodules_dtype
-        with predicted nodules.
+    nodules_true : NodulesInfo
+        info about true nodules, see CTImagesMaskedBatch.nodules.
+    nodules_pred : NodulesInfo
+        info about predicted nodules, see CTImagesMaskedBatch.nodules.
 
     Returns
     -------
@@ -1,6 +1,8 @@
 """ CT-scans preprocessing module. """
 
 from .ct_batch import CTImagesBatch
-from .ct_masked_batch import CTImagesMaskedBatch
+from .ct_masked_batch import CTImagesMaskedBatch, set_random_seed
+from .nodules_info import NodulesInfo
 from .augmented_batch import CTImagesAugmentedBatch
 from .histo import sample_ellipsoid_region
+from .patches import PatchBufferPool
@@ -19,7 +19,6 @@ try:
 except ImportError:
     import dicom
 
-import SimpleITK as sitk
 from skimage.measure import label, regionprops
 try:
     import nibabel as nib
@@ -33,7 +32,7 @@ from .segment import calc_lung_mask_numba
 from .mip import make_xip_numba, numba_xip, unfold_xip, PROJECTIONS, REVERSE_PROJECTIONS
 from .flip import flip_patient_numba
 from .crop import make_central_crop
-from .patches import get_patches_numba, assemble_patches, calc_padding_size
+from .patches import extract_patches, assemble_patches, calc_padding_size, aligned_empty
 from .rotate import rotate_3D
 from .dump import dump_data
 
@@ -616,6 +615,8 @@ class CTImagesBatch(Batch):  # pylint: disable=too-many-public-methods
         NO multithreading is used, as SimpleITK (sitk) lib crashes
         in multithreading mode in experiments.
         """
+        import SimpleITK as sitk                       # pylint: disable=import-outside-toplevel
+
         result = {}
 
         raw_data = sitk.ReadImage(self._get_file_name(patient_id, kwargs['src']))
@@ -637,7 +638,8 @@ class CTImagesBatch(Batch):  # pylint: disable=too-many-public-methods
 
     @action
     @inbatch_parallel(init='_init_dump', post='_post_default', target='async', update=False)
-    async def dump(self, ix, dst, components=None, fmt='blosc', index_to_name=None, i8_encoding_mode=None):
+    async def dump(self, ix, dst, components=None, fmt='blosc', index_to_name=None, i8_encoding_mode=None,
+                   cname='lz4', clevel=5):
         """ Dump chosen ``components`` of scans' batcn in folder ``dst`` in specified format.
 
         When some of the ``components`` are ``None``, a warning is printed and nothing is dumped.
@@ -667,6 +669,11 @@ class CTImagesBatch(Batch):  # pylint: disable=too-many-public-methods
             in float32-format. Can be int: 0, 1, 2 or str/None: 'linear', 'quantization' or None.
             0 or None disable the cast. 1 stands for 'linear', 2 - for 'quantization'.
             Can also be component-wise dict of modes, e.g.: {'images': 'linear', 'masks': 0}.
+        cname : str
+            blosc compressor for skyscraper-components. 'lz4' is the fastest, 'zstd'
+            gives better compression ratio (e.g., for archiving).
+        clevel : int
+            blosc compression level from 0 to 9.
 
         Examples
         --------
@@ -715,7 +722,7 @@ class CTImagesBatch(Batch):  # pylint: disable=too-many-public-methods
         item_subdir = ix if index_to_name is None else index_to_name(ix)
         item_dir = os.path.join(dst, item_subdir)
 
-        return await dump_data(data_items, item_dir, i8_encoding_mode)
+        return await dump_data(data_items, item_dir, i8_encoding_mode, cname, clevel)
 
     def get_pos(self, data, component, index, dst=None):
         """ Return a positon of an item for a given index in data
@@ -1625,7 +1632,8 @@ class CTImagesBatch(Batch):  # pylint: disable=too-many-public-methods
         self.origin = self.origin + self.spacing * crop_halfsize
         return self
 
-    def get_patches(self, patch_shape, stride, padding='edge', data_attr='images'):
+    def get_patches(self, patch_shape, stride, padding='edge', data_attr='images', dtype=np.float32,
+                    lo=None, hi=None, out=None):
         """ Extract patches of patch_shape with specified stride.
 
         Parameters
@@ -1638,6 +1646,19 @@ class CTImagesBatch(Batch):  # pylint: disable=too-many-public-methods
             padding-type (see doc of np.pad for available types).
         data_attr : str
             component to get data from.
+        dtype : numpy dtype
+            dtype of patches. Data is cast into it while extracting patches.
+        lo : float or None
+            if not None, patches are clipped to [lo, hi] and scaled to [0, 1]
+            while extracting, e.g. lo=-1000, hi=400 for HU-scans.
+        hi : float or None
+            upper bound of clipping. Should be set if and only if `lo` is set, and be greater than `lo`.
+        out : ndarray or None
+            C-contiguous 4d-array of shape `(num_patches, *patch_shape)`, where patches are put.
+            Allows to reuse one buffer (e.g. from `PatchBufferPool`) for many batches.
+            If None, new array of `dtype` is allocated on 64-byte boundary, so that vector
+            stores into patches are aligned; preallocated buffers should be aligned the same way
+            (see `aligned_empty`) for best performance.
 
         Returns
         -------
@@ -1665,12 +1686,17 @@ class CTImagesBatch(Batch):  # pylint: disable=too-many-public-methods
 
         # init tensor with patches
         num_sections = (np.asarray(data_padded.shape[1:]) - patch_shape) // stride + 1
-        patches = np.zeros(shape=(len(self), np.prod(num_sections), *patch_shape))
+        patches_shape = (len(self) * np.prod(num_sections), *patch_shape)
+        if out is None:
+            out = aligned_empty(patches_shape, dtype)
+        elif out.shape != patches_shape or not out.flags.c_contiguous:
+            raise ValueError('out should be C-contiguous array of shape {}, got {}'
+                             .format(patches_shape, out.shape))
 
         # put patches into the tensor
-        get_patches_numba(data_padded, patch_shape, stride, patches)
-        patches = np.reshape(patches, (len(self) * np.prod(num_sections), *patch_shape))
-        return patches
+        patches = out.reshape(len(self), np.prod(num_sections), *patch_shape)
+        extract_patches(data_padded, patch_shape, stride, patches, lo, hi)
+        return out
 
     def load_from_patches(self, patches, stride, scan_shape, data_attr='images'):
         """ Get skyscraper from 4d-array of patches, put it to `data_attr` component in batch.
@@ -1691,6 +1717,7 @@ class CTImagesBatch(Batch):  # pylint: disable=too-many-public-methods
         Notes
         -----
         If stride != patch.shape(), averaging of overlapped regions is used.
+        Assembled data is of the same dtype as patches if it is floating, float32 otherwise.
         `scan_shape`, patches.shape(), `stride` are used to infer the number of items
         in new skyscraper. If patches were padded, padding is removed for skyscraper.
 
@@ -1711,7 +1738,8 @@ class CTImagesBatch(Batch):  # pylint: disable=too-many-public-methods
         scan_shape_adj = scan_shape + shape_delta
 
         # init 4d tensor and put assembled scans into it
-        data_4d = np.zeros((len(self), *scan_shape_adj))
+        dtype = patches.dtype if np.issubdtype(patches.dtype, np.floating) else np.float32
+        data_4d = np.empty((len(self), *scan_shape_adj), dtype=dtype)
         patches = np.reshape(patches, (len(self), -1, *patch_shape))
         assemble_patches(patches, stride, data_4d)
 
@@ -6,11 +6,13 @@
 
 """ Batch class CTImagesMaskedBatch for storing CT-scans with masks. """
 
+import os
 import logging
+from binascii import hexlify
 
 import numpy as np
 import pandas as pd
-from numba import njit
+from numba import njit, prange
 from skimage import measure
 
 try:
@@ -19,25 +21,47 @@ except ImportError:
     tqdm_notebook = lambda x: x
 
 from .ct_batch import CTImagesBatch
-from .mask import make_rect_mask_numba, make_ellipse_mask_numba, create_mask_reg
+from .nodules_info import NodulesInfo
+from .mask import (make_rect_mask_numba, make_ellipse_mask_numba, create_mask_reg,
+                   get_nodules_pixel_bounds_numba)
 from .histo import sample_histo3d
 from .crop import make_central_crop
+from .resize import resize_scipy
 from ..batchflow import action, DatasetIndex, SkipBatchException  # pylint: disable=no-name-in-module
 
 
 # logger initialization
 logger = logging.getLogger(__name__) # pylint: disable=invalid-name
 
+# random generator for sampling crops and mixing images
+RNG = np.random.default_rng()
 
-@njit(nogil=True)
-def get_nodules_numba(data, positions, size):
-    """ Fetch nodules from array by starting positions.
+
+def set_random_seed(seed=None):
+    """ Seed random generator used by CTImagesMaskedBatch for sampling crops,
+    shifting nodules and mixing images.
+
+    Parameters
+    ----------
+    seed : int, sequence of int or None
+        seed for `np.random.default_rng`. If None, fresh entropy is used.
+
+    Notes
+    -----
+    `np.random.seed` has no effect on these actions; use this function
+    to make pipelines reproducible.
+    """
+    RNG.bit_generator.state = np.random.default_rng(seed).bit_generator.state
+
+
+@njit(parallel=True, nogil=True)
+def get_nodules_numba(data, positions, size, out):
+    """ Fetch nodules from array by starting positions, put them into out.
 
     Takes array with data of shape (z, y, x) from `batch`,
     ndarray(p, 3) with starting indices of nodules where p is number
     of nodules and size of type ndarray(3, ) which contains
-    sizes of nodules along each axis. The output is 3d ndarray with nodules
-    put in CTImagesBatch-compatible skyscraper structure.
+    sizes of nodules along each axis. Nodules are copied in parallel.
 
     Parameters
     ----------
@@ -47,26 +71,145 @@ def get_nodules_numba(data, positions, size):
         Contains nodules' starting indices along [zyx]-axis accordingly in `data`.
     size : ndarray(3,) of int
         Contains nodules' sizes along each axis (z,y,x).
+    out : ndarray(l, z, y, x)
+        4d ndarray, where nodules are put.
 
     Notes
     -----
     Dtypes of positions and size arrays must be the same.
+    """
+    size = size.astype(np.int64)
+    n_positions = positions.shape[0]
+
+    for i in prange(n_positions):                                         # pylint: disable=not-an-iterable
+        out[i, :, :, :] = data[positions[i, 0]: positions[i, 0] + size[0],
+                               positions[i, 1]: positions[i, 1] + size[1],
+                               positions[i, 2]: positions[i, 2] + size[2]]
+
+
+def _is_slab_sequence(data, positions, size):
+    """ Check if nodules are consecutive (along z) full-size slabs of C-contiguous `data`. """
+    if positions.shape[0] == 0 or not data.flags.c_contiguous:
+        return False
+    if np.any(size[1:] != data.shape[1:]) or np.any(positions[:, 1:] != 0):
+        return False
+    return np.all(positions[:, 0] == positions[0, 0] + np.arange(positions.shape[0]) * size[0])
+
+
+def get_nodules(data, positions, size):
+    """ Fetch nodules from array by starting positions.
+
+    Parameters
+    ----------
+    data : ndarray
+        CTImagesBatch `skyscraper` represented by 3D ndarray.
+    positions : ndarray(l, 3) of int
+        Contains nodules' starting indices along [zyx]-axis accordingly in `data`.
+    size : ndarray(3,) of int
+        Contains nodules' sizes along each axis (z,y,x).
 
     Returns
     -------
     ndarray
-        3d ndarray with nodules
+        4d ndarray(l, z, y, x) with nodules.
+        Use `.reshape(-1, size[1], size[2])` to put nodules in
+        CTImagesBatch-compatible skyscraper structure (no copy is made).
+
+    Notes
+    -----
+    If nodules are consecutive full-size slabs of `data` (i.e., cover whole
+    (y, x)-slices and follow each other along z), no copy is made and a view
+    of `data` is returned. Otherwise, a new array of the same dtype as `data` is allocated.
     """
-    size = size.astype(np.int64)
-    out_arr = np.zeros((positions.shape[0], size[0], size[1], size[2]))
+    size = np.asarray(size, dtype=np.int64)
+    shape = (positions.shape[0], *size)
+    if _is_slab_sequence(data, positions, size):
+        start = positions[0, 0]
+        return data[start: start + shape[0] * size[0]].reshape(shape)
 
-    n_positions = positions.shape[0]
-    for i in range(n_positions):
-        out_arr[i, :, :, :] = data[positions[i, 0]: positions[i, 0] + size[0],
-                                   positions[i, 1]: positions[i, 1] + size[1],
-                                   positions[i, 2]: positions[i, 2] + size[2]]
+    out = np.empty(shape, dtype=data.dtype)
+    get_nodules_numba(data, positions, size, out)
+    return out
+
+@njit(parallel=True, nogil=True)
+def get_nodules_with_masks_numba(data, masks, positions, size, masks_positions, masks_size,   # pylint: disable=too-many-arguments
+                                 out, out_masks):
+    """ Fetch nodules from data and masks by starting positions in one parallel pass.
+
+    Parameters
+    ----------
+    data : ndarray
+        CTImagesBatch `skyscraper` represented by 3D ndarray.
+    masks : ndarray
+        `skyscraper` with masks represented by 3D ndarray.
+    positions : ndarray(l, 3) of int
+        Contains nodules' starting indices along [zyx]-axis accordingly in `data`.
+    size : ndarray(3,) of int
+        Contains nodules' sizes along each axis (z,y,x) in `data`.
+    masks_positions : ndarray(l, 3) of int
+        Contains nodules' starting indices along [zyx]-axis accordingly in `masks`.
+    masks_size : ndarray(3,) of int
+        Contains nodules' sizes along each axis (z,y,x) in `masks`.
+    out : ndarray(l, z, y, x)
+        4d ndarray, where nodules from `data` are put.
+    out_masks : ndarray(l, z, y, x)
+        4d ndarray, where nodules from `masks` are put.
+    """
+    for i in prange(positions.shape[0]):                                    # pylint: disable=not-an-iterable
+        out[i, :, :, :] = data[positions[i, 0]: positions[i, 0] + size[0],
+                               positions[i, 1]: positions[i, 1] + size[1],
+                               positions[i, 2]: positions[i, 2] + size[2]]
+        out_masks[i, :, :, :] = masks[masks_positions[i, 0]: masks_positions[i, 0] + masks_size[0],
+                                      masks_positions[i, 1]: masks_positions[i, 1] + masks_size[1],
+                                      masks_positions[i, 2]: masks_positions[i, 2] + masks_size[2]]
+
+
+def get_nodules_with_masks(data, masks, positions, size, masks_positions, masks_size,     # pylint: disable=too-many-arguments
+                           copy_images=True, copy_masks=True):
+    """ Fetch nodules from data and corresponding masks by starting positions.
+
+    Parameters
+    ----------
+    data : ndarray
+        CTImagesBatch `skyscraper` represented by 3D ndarray.
+    masks : ndarray
+        `skyscraper` with masks represented by 3D ndarray.
+    positions : ndarray(l, 3) of int
+        Contains nodules' starting indices along [zyx]-axis accordingly in `data`.
+    size : ndarray(3,) of int
+        Contains nodules' sizes along each axis (z,y,x) in `data`.
+    masks_positions : ndarray(l, 3) of int
+        Contains nodules' starting indices along [zyx]-axis accordingly in `masks`.
+    masks_size : ndarray(3,) of int
+        Contains nodules' sizes along each axis (z,y,x) in `masks`.
+    copy_images : bool
+        if True, nodules are always copied. Otherwise, a view of `data` may be returned.
+    copy_masks : bool
+        if True, masks are always copied. Otherwise, a view of `masks` may be returned.
+        Should be set when `masks` is an array shared between calls, e.g. a cached one.
+
+    Returns
+    -------
+    tuple
+        (nodules, masks) 4d ndarrays(l, z, y, x) of the same dtypes as `data` and `masks`.
+        See :func:`get_nodules` for when views can be returned.
+    """
+    size = np.asarray(size, dtype=np.int64)
+    masks_size = np.asarray(masks_size, dtype=np.int64)
+    if _is_slab_sequence(data, positions, size) or _is_slab_sequence(masks, masks_positions, masks_size):
+        nodules = get_nodules(data, positions, size)
+        if copy_images and not nodules.flags.owndata:
+            nodules = nodules.copy()
+        nodules_masks = get_nodules(masks, masks_positions, masks_size)
+        if copy_masks and not nodules_masks.flags.owndata:
+            nodules_masks = nodules_masks.copy()
+        return nodules, nodules_masks
+
+    out = np.empty((positions.shape[0], *size), dtype=data.dtype)
+    out_masks = np.empty((positions.shape[0], *masks_size), dtype=masks.dtype)
+    get_nodules_with_masks_numba(data, masks, positions, size, masks_positions, masks_size, out, out_masks)
+    return out, out_masks
 
-    return out_arr.reshape(n_positions * size[0], size[1], size[2])
 
 @njit
 def mix_images_numba(images, masks, bounds, permutation, p, mode, mix_masks):
@@ -98,7 +241,7 @@ def mix_images_numba(images, masks, bounds, permutation, p, mode, mix_masks):
     bounds = np.concatenate((np.zeros(1), bounds))
 
     images_to_add = np.zeros_like(images)
-    masks_to_add = np.zeros_like(images)
+    masks_to_add = np.zeros_like(masks)
 
     for i in range(len(bounds)-1):
         old_slice = slice(bounds[i], bounds[i+1])
@@ -140,9 +283,9 @@ class CTImagesMaskedBatch(CTImagesBatch):
         contains ct-scans for all patients in batch.
     masks : ndarray
         contains masks for all patients in batch.
-    nodules : np.recarray
+    nodules : NodulesInfo
         contains info on cancer nodules location.
-        record array contains the following information about nodules:
+        each field is a separate ndarray; the following information about nodules is stored:
           - self.nodules.nodule_center -- ndarray(num_nodules, 3) centers of
             nodules in world coords;
           - self.nodules.nodule_size -- ndarray(num_nodules, 3) sizes of
@@ -157,14 +300,6 @@ class CTImagesMaskedBatch(CTImagesBatch):
             of patients which correspond to nodules.
     """
 
-    nodules_dtype = np.dtype([('patient_pos', np.int, 1),
-                              ('offset', np.int, (3,)),
-                              ('img_size', np.int, (3,)),
-                              ('nodule_center', np.float, (3,)),
-                              ('nodule_size', np.float, (3,)),
-                              ('spacing', np.float, (3,)),
-                              ('origin', np.float, (3,))])
-
     components = "images", "masks", "spacing", "origin"
 
     @staticmethod
@@ -190,7 +325,9 @@ class CTImagesMaskedBatch(CTImagesBatch):
                '68f9f235', '8f7b0c49', 'c7903591', 'dc8e9504', '54e9eebc',
                '778abd5a', '99691fc6', '7da49e85', '0f343345', '876fb9e6'], dtype='<U8')
         """
-        return np.array([CTImagesMaskedBatch.make_filename() for i in range(size)])
+        # read random bytes for all indices at once, 4 bytes give 8 hex-digits
+        hex_digits = hexlify(os.urandom(4 * size)).decode("utf-8")
+        return np.array([hex_digits[i: i + 8] for i in range(0, 8 * size, 8)])
 
     def __init__(self, index, *args, **kwargs):
         """ Execute Batch construction and init of basic attributes
@@ -203,9 +340,10 @@ class CTImagesMaskedBatch(CTImagesBatch):
         super().__init__(index, *args, **kwargs)
         self.masks = None
         self.nodules = None
+        self._masks_cache = {}
 
     def nodules_to_df(self, nodules):
-        """ Convert nodules_info ndarray into pandas dataframe.
+        """ Convert NodulesInfo into pandas dataframe.
 
         Pandas DataFrame will contain following columns:
         'source_id' - id of source element of batch;
@@ -215,8 +353,8 @@ class CTImagesMaskedBatch(CTImagesBatch):
 
         Parameters
         ----------
-        nodules : ndarray of type nodules_info
-            nodules_info type is defined inside of CTImagesMaskedBatch class.
+        nodules : NodulesInfo
+            info about nodules, e.g. `nodules` attribute of CTImagesMaskedBatch.
 
         Returns
         -------
@@ -302,7 +440,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
              - 'seriesuid': index of patient or series.
              - 'coordZ','coordY','coordX': coordinates of nodules center.
              - 'diameter_mm': diameter, in mm.
-        nodules_records : np.recarray
+        nodules_records : NodulesInfo or np.recarray
             if not None, should
             contain the same fields as describe in Note.
         update : bool
@@ -322,7 +460,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
         Notes
         -----
         Run this action only after  :func:`~radio.CTImagesBatch.load`.
-        The method fills in record array self.nodules that contains the following information about nodules:
+        The method fills in NodulesInfo self.nodules that contains the following information about nodules:
                                - self.nodules.nodule_center -- ndarray(num_nodules, 3) centers of
                                  nodules in world coords;
                                - self.nodules.nodule_size -- ndarray(num_nodules, 3) sizes of
@@ -346,8 +484,8 @@ class CTImagesMaskedBatch(CTImagesBatch):
             return self
 
         if nodules_records is not None:
-            # load from record-array
-            self.nodules = nodules_records
+            # load from record-array or NodulesInfo
+            self.nodules = NodulesInfo.from_records(nodules_records)
 
         else:
             # assume that nodules is supplied and load from it
@@ -368,17 +506,15 @@ class CTImagesMaskedBatch(CTImagesBatch):
                                          "coordX", "diameter_mm"]]
 
             num_nodules = nodules_df.shape[0]
-            self.nodules = np.rec.array(np.zeros(num_nodules,
-                                                 dtype=self.nodules_dtype))
-            counter = 0
-            for pat_id, coordz, coordy, coordx, diam in nodules_df.itertuples():
-                pat_pos = self.index.get_pos(pat_id)
-                self.nodules.patient_pos[counter] = pat_pos
-                self.nodules.nodule_center[counter, :] = np.array([coordz,
-                                                                   coordy,
-                                                                   coordx])
-                self.nodules.nodule_size[counter, :] = np.array([diam, diam, diam])
-                counter += 1
+            self.nodules = NodulesInfo(num_nodules)
+            # find patients' positions in batch by binary search over sorted indices,
+            # fill records columnwise
+            indices = np.asarray(self.indices)
+            sorted_pos = np.argsort(indices)
+            self.nodules.patient_pos[:] = sorted_pos[np.searchsorted(indices[sorted_pos],
+                                                                     nodules_df.index.values)]
+            self.nodules.nodule_center[:] = nodules_df[["coordZ", "coordY", "coordX"]].values
+            self.nodules.nodule_size[:] = nodules_df[["diameter_mm"]].values
 
         self._refresh_nodules_info(images_loaded)
         return self
@@ -389,7 +525,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
 
         Runs skimage.measure.labels for fetching nodules regions
         from masks. Extracts nodules info from segmented regions
-        and put this information in self.nodules np.recarray.
+        and put this information in self.nodules NodulesInfo.
 
         Parameters
         ----------
@@ -417,18 +553,17 @@ class CTImagesMaskedBatch(CTImagesBatch):
             for props in measure.regionprops(np.int16(mask_labels)):
                 center = np.asarray((props.centroid[0],
                                      props.centroid[1],
-                                     props.centroid[2]), dtype=np.float)
+                                     props.centroid[2]), dtype=np.float32)
                 center = center * self.spacing[pos] + self.origin[pos]
 
                 diameter = np.asarray(
-                    [props.equivalent_diameter] * 3, dtype=np.float)
+                    [props.equivalent_diameter] * 3, dtype=np.float32)
                 diameter = diameter * self.spacing[pos]
                 nodules_list.append({'patient_pos': pos,
                                      'nodule_center': center,
                                      'nodule_size': diameter})
         num_nodules = len(nodules_list)
-        self.nodules = np.rec.array(
-            np.zeros(num_nodules, dtype=self.nodules_dtype))
+        self.nodules = NodulesInfo(num_nodules)
         for i, nodule in enumerate(nodules_list):
             self.nodules.patient_pos[i] = nodule['patient_pos']
             self.nodules.nodule_center[i, :] = nodule['nodule_center']
@@ -458,26 +593,21 @@ class CTImagesMaskedBatch(CTImagesBatch):
         ndarray
             start coordinates (z,y,x) of all nodules in batch.
         """
-        size = np.array(size, dtype=np.int)
+        size = np.array(size, dtype=np.int64)
 
         center_pix = np.abs(self.nodules.nodule_center -
                             self.nodules.origin) / self.nodules.spacing
         start_pix = (np.rint(center_pix) - np.rint(size / 2))
         if variance is not None:
-            start_pix += np.random.multivariate_normal(np.zeros(3),
-                                                       np.diag(variance),
-                                                       self.nodules.patient_pos.shape[0])
-        end_pix = start_pix + size
-
-        bias_upper = np.maximum(end_pix - self.nodules.img_size, 0)
-        start_pix -= bias_upper
-        end_pix -= bias_upper
+            # covariance is diagonal, so shifts along axes are independent
+            start_pix += (RNG.standard_normal((self.nodules.patient_pos.shape[0], 3))
+                          * np.sqrt(variance))
 
-        bias_lower = np.maximum(-start_pix, 0)
-        start_pix += bias_lower
-        end_pix += bias_lower
+        # shift nodules inside scans: clamp starts to [0, img_size - size];
+        # if nodule is larger than scan, it starts at 0
+        start_pix = np.clip(start_pix, 0, np.maximum(self.nodules.img_size - size, 0))
 
-        return (start_pix + self.nodules.offset).astype(np.int)
+        return (start_pix + self.nodules.offset).astype(np.int64)
 
     @action
     def create_mask(self, mode='rectangle'):
@@ -493,27 +623,28 @@ class CTImagesMaskedBatch(CTImagesBatch):
         `nodules` must be not None before calling this method.
         see :func:`~radio.preprocessing.ct_masked_batch.CTImagesMaskedBatch.fetch_nodules_info`
         for more details.
+        Created `masks` are binary and have dtype uint8.
         """
         if self.nodules is None:
             message = ("Info about nodules location must " +
                        "be loaded before calling this method. " +
                        "Nothing happened.")
             logger.warning(message)
-        self.masks = np.zeros_like(self.images)
+        self.masks = np.zeros(self.images.shape, dtype=np.uint8)
 
-        center_pix = np.abs(self.nodules.nodule_center -
-                            self.nodules.origin) / self.nodules.spacing
-        radius_pix = np.rint(self.nodules.nodule_size / self.nodules.spacing / 2)
-
-        center_pix = np.rint(center_pix).astype(np.int)
-        radius_pix = np.rint(radius_pix).astype(np.int)
         if mode == 'rectangle':
-            start_pix = (center_pix - radius_pix)
-            start_pix = np.rint(start_pix).astype(np.int)
+            start_pix, size_pix = get_nodules_pixel_bounds_numba(self.nodules.nodule_center, self.nodules.origin,
+                                                                 self.nodules.spacing, self.nodules.nodule_size,
+                                                                 np.ones(3), True)
             make_rect_mask_numba(self.masks, self.nodules.offset,
-                                 self.nodules.img_size + self.nodules.offset, start_pix,
-                                 np.rint(self.nodules.nodule_size / self.nodules.spacing))
+                                 self.nodules.img_size + self.nodules.offset, start_pix, size_pix)
         elif mode == 'ellipse':
+            center_pix = np.abs(self.nodules.nodule_center -
+                                self.nodules.origin) / self.nodules.spacing
+            radius_pix = np.rint(self.nodules.nodule_size / self.nodules.spacing / 2)
+
+            center_pix = np.rint(center_pix).astype(np.int64)
+            radius_pix = np.rint(radius_pix).astype(np.int64)
             make_ellipse_mask_numba(self.masks, self.nodules.offset.astype(np.int32),
                                     self.nodules.img_size + self.nodules.offset,
                                     center_pix, radius_pix)
@@ -548,10 +679,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
         Returns
         -------
         ndarray
-            3d array with masks in form of `skyscraper`.
-
-        # TODO: one part of code from here repeats create_mask function
-            better to unify these two func
+            3d array of uint8 with masks in form of `skyscraper`.
         """
         if self.nodules is None:
             message = ("Info about nodules location must " +
@@ -559,31 +687,49 @@ class CTImagesMaskedBatch(CTImagesBatch):
                        "Nothing happened.")
             logger.warning(message)
 
-        mask = np.zeros(shape=(len(self) * shape[0], *shape[1:]))
+        mask = np.zeros(shape=(len(self) * shape[0], *shape[1:]), dtype=np.uint8)
 
         # infer scale factor; assume patients are already resized to equal
         # shapes
         scale_factor = np.asarray(shape) / self.images_shape[0, :]
 
-        # get rescaled nodule-centers, nodule-sizes, offsets, locs of nod
-        # starts
-        center_scaled = (np.abs(self.nodules.nodule_center - self.nodules.origin) /
-                         self.nodules.spacing * scale_factor)
-        start_scaled = (center_scaled - scale_factor * self.nodules.nodule_size /
-                        self.nodules.spacing / 2)
-        start_scaled = np.rint(start_scaled).astype(np.int)
+        # get rescaled locs of nod starts, nodule-sizes, offsets
+        start_scaled, nod_size_scaled = get_nodules_pixel_bounds_numba(self.nodules.nodule_center,
+                                                                       self.nodules.origin,
+                                                                       self.nodules.spacing,
+                                                                       self.nodules.nodule_size,
+                                                                       scale_factor, False)
         offset_scaled = np.rint(self.nodules.offset *
-                                scale_factor).astype(np.int)
+                                scale_factor).astype(np.int64)
         img_size_scaled = np.rint(
-            self.nodules.img_size * scale_factor).astype(np.int)
-        nod_size_scaled = (np.rint(scale_factor * self.nodules.nodule_size /
-                                   self.nodules.spacing)).astype(np.int)
+            self.nodules.img_size * scale_factor).astype(np.int64)
         # put nodules into mask
         make_rect_mask_numba(mask, offset_scaled, img_size_scaled + offset_scaled,
                              start_scaled, nod_size_scaled)
         # return ndarray-mask
         return mask
 
+    def _fetch_mask_cached(self, shape):
+        """ Get mask of given shape from `fetch_mask`, reusing the mask
+        computed in previous call if nodules and scans' shapes did not change.
+
+        Parameters
+        ----------
+        shape : tuple, list or ndarray of int.
+            (z_dim,y_dim,x_dim), shape of mask to be created.
+
+        Returns
+        -------
+        ndarray
+            3d array with masks in form of `skyscraper`. Should not be modified.
+        """
+        key = (tuple(shape), self.images_shape.tobytes(),
+               *(getattr(self.nodules, name).tobytes() for name, _, _ in NodulesInfo.fields))
+        if key not in self._masks_cache:
+            # only the last mask is stored
+            self._masks_cache = {key: self.fetch_mask(shape)}
+        return self._masks_cache[key]
+
     # TODO rename function to sample_random_nodules_positions
     def sample_random_nodules(self, num_nodules, nodule_size, histo=None):
         """ Sample random nodules positions in CTImagesBatchMasked.
@@ -610,7 +756,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
             in batch `skyscraper`.
         """
         all_indices = np.arange(len(self))
-        sampled_indices = np.random.choice(
+        sampled_indices = RNG.choice(
             all_indices, num_nodules, replace=True)
 
         offset = np.zeros((num_nodules, 3))
@@ -619,7 +765,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
 
         # if supplied, use histogram as the sampler
         if histo is None:
-            sampler = lambda size: np.random.rand(size, 3)
+            sampler = lambda size: RNG.random((size, 3))
         else:
             sampler = lambda size: sample_histo3d(histo, size)
 
@@ -628,11 +774,11 @@ class CTImagesMaskedBatch(CTImagesBatch):
         if histo is not None:
             samples /= data_shape
 
-        return np.asarray(samples + offset, dtype=np.int), sampled_indices
+        return np.asarray(samples + offset, dtype=np.int64), sampled_indices
 
     @action
     def sample_nodules(self, batch_size, nodule_size=(32, 64, 64), share=0.8, variance=None,        # pylint: disable=too-many-locals, too-many-statements
-                       mask_shape=None, histo=None):
+                       mask_shape=None, histo=None, share_memory=False):
         """ Sample random crops of `images` and `masks` from batch.
 
         Create random crops, both with and without nodules in it, from input batch.
@@ -659,6 +805,9 @@ class CTImagesMaskedBatch(CTImagesBatch):
         histo : tuple
             np.histogram()'s output.
             Used for sampling non-cancerous crops.
+        share_memory : bool
+            if True, `images` and `masks` of resulting batch may be views of this
+            batch's components, so that no copy is made. Otherwise, crops are always copied.
 
         Returns
         -------
@@ -666,14 +815,21 @@ class CTImagesMaskedBatch(CTImagesBatch):
             batch with cancerous and non-cancerous crops in a proportion defined by
             `share` with total `batch_size` nodules. If `share` == 1.0, `batch_size`
             is None, resulting batch consists of all cancerous crops stored in batch.
+
+        Notes
+        -----
+        With `share_memory` set, views are returned when crops are whole consecutive
+        scans of the batch (e.g., `nodule_size` equals shape of scans). In-place actions
+        on the resulting batch, like `binarize_mask` or `segment`, then modify this batch.
+        Masks scaled to `mask_shape` are cached between calls and are always copied.
         """
         # make sure that nodules' info is fetched and args are OK
         if self.nodules is None:
             raise AttributeError("Info about nodules location must " +
                                  "be loaded before calling this method")
         if variance is not None:
-            variance = np.asarray(variance, dtype=np.int)
-            variance = variance.flatten()
+            variance = np.asarray(variance, dtype=np.int64)
+            variance = variance.ravel()
             if len(variance) != 3:
                 message = ('Argument variance be np.array-like' +
                            'and has shape (3,). ' +
@@ -696,11 +852,12 @@ class CTImagesMaskedBatch(CTImagesBatch):
         if batch_size == 0:
             raise SkipBatchException('Batch of zero size cannot be passed further through the workflow')
 
+        # starting positions of crops: cancerous crops go first, then random ones
+        nodules_st_pos = np.empty((batch_size, 3), dtype=np.int64)
+
         # choose cancerous nodules' starting positions
-        nodule_size = np.asarray(nodule_size, dtype=np.int)
-        if self.num_nodules == 0:
-            cancer_nodules = np.zeros((0, 3))
-        else:
+        nodule_size = np.asarray(nodule_size, dtype=np.int64)
+        if self.num_nodules > 0:
             # adjust cancer nodules' starting positions s.t. nodules fit into
             # scan-boxes
             cancer_nodules = self._fit_into_bounds(
@@ -708,47 +865,46 @@ class CTImagesMaskedBatch(CTImagesBatch):
 
             # randomly select needed number of cancer nodules (their starting
             # positions)
-            sample_indices = np.random.choice(np.arange(self.num_nodules),
-                                              size=cancer_n, replace=False)
-            cancer_nodules = cancer_nodules[sample_indices, :]
+            sample_indices = RNG.choice(np.arange(self.num_nodules),
+                                        size=cancer_n, replace=False)
+            nodules_st_pos[:cancer_n] = cancer_nodules[sample_indices, :]
 
             # store scans-indices for chosen crops
-            cancerous_indices = self.nodules.patient_pos[sample_indices].reshape(-1)
+            cancerous_indices = self.nodules.patient_pos[sample_indices].ravel()
             crops_indices = np.concatenate([crops_indices, cancerous_indices])
 
-        nodules_st_pos = cancer_nodules
-
         # if non-cancerous nodules are needed, add random starting pos
         if batch_size - cancer_n > 0:
             # sample starting positions for (most-likely) non-cancerous crops
             random_nodules, random_indices = self.sample_random_nodules(batch_size - cancer_n,
                                                                         nodule_size, histo=histo)
-
-            # concat non-cancerous and cancerous crops' starting positions
-            nodules_st_pos = np.vstack([nodules_st_pos, random_nodules]).astype(
-                np.int)  # pylint: disable=no-member
+            nodules_st_pos[cancer_n:] = random_nodules
 
             # store scan-indices for randomly chose crops
             crops_indices = np.concatenate([crops_indices, random_indices])
 
-        # obtain nodules' scans by cropping from self.images
-        images = get_nodules_numba(self.images, nodules_st_pos, nodule_size)
-
         # if mask_shape not None, compute scaled mask for the whole batch
         # scale also nodules' starting positions and nodules' shapes
         if mask_shape is not None:
-            scale_factor = np.asarray(mask_shape) / np.asarray(nodule_size)
+            mask_shape = np.asarray(mask_shape, dtype=np.int64)
+            scale_factor = mask_shape / nodule_size
             batch_mask_shape = np.rint(
-                scale_factor * self.images_shape[0, :]).astype(np.int)
-            batch_mask = self.fetch_mask(batch_mask_shape)
-            nodules_st_pos = np.rint(
-                scale_factor * nodules_st_pos).astype(np.int)
+                scale_factor * self.images_shape[0, :]).astype(np.int64)
+            batch_mask = self._fetch_mask_cached(batch_mask_shape)
+            masks_st_pos = np.rint(
+                scale_factor * nodules_st_pos).astype(np.int64)
         else:
             batch_mask = self.masks
             mask_shape = nodule_size
+            masks_st_pos = nodules_st_pos
 
-        # crop nodules' masks
-        masks = get_nodules_numba(batch_mask, nodules_st_pos, mask_shape)
+        # obtain nodules' scans and masks by cropping from self.images and mask
+        # scaled mask is cached between calls, so its crops must not be views
+        images, masks = get_nodules_with_masks(self.images, batch_mask, nodules_st_pos, nodule_size,
+                                               masks_st_pos, mask_shape, copy_images=not share_memory,
+                                               copy_masks=not share_memory or batch_mask is not self.masks)
+        images = images.reshape(-1, *nodule_size[1:])
+        masks = masks.reshape(-1, *mask_shape[1:])
 
         # build nodules' batch
         bounds = np.arange(batch_size + 1) * nodule_size[0]
@@ -766,10 +922,8 @@ class CTImagesMaskedBatch(CTImagesBatch):
         new_patient_pos = []
         for i, records in enumerate(nodules_records):
             new_patient_pos += [i] * len(records)
-        new_patient_pos = np.array(new_patient_pos)
-        nodules_records = np.concatenate(nodules_records)
-        nodules_records = nodules_records.view(np.recarray)
-        nodules_records.patient_pos = new_patient_pos
+        nodules_records = NodulesInfo.concatenate(nodules_records)
+        nodules_records.patient_pos[:] = new_patient_pos
         nodules_batch.fetch_nodules_info(nodules_records=nodules_records)
 
         # leave out nodules with zero-intersection with crops' boxes
@@ -874,14 +1028,14 @@ class CTImagesMaskedBatch(CTImagesBatch):
         if images_loaded:
             self.nodules.offset[:, 0] = self.lower_bounds[
                 self.nodules.patient_pos]
-            self.nodules.img_size = self.images_shape[
+            self.nodules.img_size[:] = self.images_shape[
                 self.nodules.patient_pos, :]
 
-        self.nodules.spacing = self.spacing[self.nodules.patient_pos, :]
-        self.nodules.origin = self.origin[self.nodules.patient_pos, :]
+        self.nodules.spacing[:] = self.spacing[self.nodules.patient_pos, :]
+        self.nodules.origin[:] = self.origin[self.nodules.patient_pos, :]
 
     def _filter_nodules_info(self):
-        """ Filter record-array self.nodules s.t. only records about cancerous nodules
+        """ Filter self.nodules s.t. only records about cancerous nodules
         that have non-zero intersection with scan-boxes be present.
 
         Notes
@@ -891,7 +1045,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
         # nodules start and trailing pixel-coords
         center_pix = (self.nodules.nodule_center - self.nodules.origin) / self.nodules.spacing
         start_pix = center_pix - np.rint(self.nodules.nodule_size / self.nodules.spacing / 2)
-        start_pix = np.rint(start_pix).astype(np.int)
+        start_pix = np.rint(start_pix).astype(np.int64)
         end_pix = start_pix + np.rint(self.nodules.nodule_size / self.nodules.spacing)
 
         # find nodules with no intersection with scan-boxes
@@ -967,15 +1121,68 @@ class CTImagesMaskedBatch(CTImagesBatch):
         Returns
         -------
         batch
+
+        Notes
+        -----
+        If nodules info is available, `masks` are created anew from it, as this
+        only requires filling the nodules' boxes. Otherwise, if action changes shapes
+        of images (resize, unify_spacing), `masks` are resized to new shapes of `images`
+        using nearest-neighbour interpolation; other actions can't be applied to
+        masks without nodules info, so ValueError is raised.
         """
         # TODO: process errors
+        masks, bounds, spacing = self.masks, self._bounds, self.spacing
         batch = super()._post_rebuild(all_outputs, new_batch, **kwargs)
         batch.nodules = self.nodules
         batch._rescale_spacing()  # pylint: disable=protected-access
-        if self.masks is not None:
-            batch.create_mask()
+        if masks is not None:
+            if self.nodules is not None:
+                batch.create_mask()
+            elif 'shape' in kwargs:
+                batch.masks = self._resize_masks(masks, bounds, spacing, batch, **kwargs)
+            else:
+                raise ValueError("Masks can't be transformed along with images without info about nodules. " +
+                                 "Load nodules info by fetch_nodules_info or drop masks before this action.")
         return batch
 
+    @staticmethod
+    def _resize_masks(masks, bounds, spacing, batch, **kwargs):
+        """ Resize `masks` skyscraper to shapes of `images` in `batch` with
+        nearest-neighbour interpolation.
+
+        Parameters
+        ----------
+        masks : ndarray
+            `masks` skyscraper before rebuild.
+        bounds : ndarray
+            bounds of items in `masks`.
+        spacing : ndarray
+            spacing of items before rebuild.
+        batch : CTImagesMaskedBatch
+            rebuilt batch.
+        **kwargs
+                spacing : tuple, list or ndarray of float
+                    (z,y,x)-spacing for each image. If supplied, assume that
+                    unify_spacing is performed.
+
+        Returns
+        -------
+        ndarray
+            resized `masks` skyscraper.
+        """
+        # unify_spacing resamples images even if their shapes do not change
+        same_spacing = 'spacing' not in kwargs or np.allclose(spacing, np.asarray(kwargs['spacing']))
+        if (same_spacing and np.array_equal(bounds, batch._bounds)                     # pylint: disable=protected-access
+                and masks.shape == batch.images.shape):
+            return masks
+
+        new_masks = np.zeros(batch.images.shape, dtype=masks.dtype)
+        for i in range(len(batch)):
+            factor = spacing[i] / np.asarray(kwargs['spacing']) if 'spacing' in kwargs else None
+            resize_scipy(masks[bounds[i]: bounds[i + 1]], new_masks[batch.lower_bounds[i]: batch.upper_bounds[i]],
+                         new_masks, order=0, factor=factor, padding='constant')
+        return new_masks
+
     @action
     def make_xip(self, depth, stride=1, mode='max', projection='axial', padding='reflect', **kwargs):
         """ Make intensity projection (maximum, minimum, mean or median).
@@ -1032,7 +1239,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
         -------
         batch
         """
-        crop_size = np.asarray(crop_size).reshape(-1)
+        crop_size = np.asarray(crop_size).ravel()
         crop_halfsize = np.rint(crop_size / 2)
         img_shapes = [np.asarray(self.get(i, 'images').shape)
                       for i in range(len(self))]
@@ -1089,7 +1296,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
             threshold for masks binarization.
 
         """
-        self.masks *= np.asarray(self.masks > threshold, dtype=np.int)
+        self.masks *= np.asarray(self.masks > threshold, dtype=self.masks.dtype)
         return self
 
     @action
@@ -1139,8 +1346,8 @@ class CTImagesMaskedBatch(CTImagesBatch):
                              + " If callable then 'model_type' argument's value "
                              + "must be set to 'callable'")
 
-        crop_shape = np.asarray(crop_shape).reshape(-1)
-        strides = np.asarray(strides).reshape(-1)
+        crop_shape = np.asarray(crop_shape).ravel()
+        strides = np.asarray(strides).ravel()
 
         patches_arr = self.get_patches(patch_shape=crop_shape,
                                        stride=strides,
@@ -1241,7 +1448,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
             nodules ('1') and non-cancerous nodules ('0').
         """
         masks_labels = np.asarray([self.get(i, 'masks').sum() > threshold
-                                   for i in range(len(self))], dtype=np.int)
+                                   for i in range(len(self))], dtype=np.int64)
         return masks_labels[..., np.newaxis]
 
     def regression_targets(self, threshold=10, **kwargs):
@@ -1262,8 +1469,8 @@ class CTImagesMaskedBatch(CTImagesBatch):
         """
         nodules = self.nodules
 
-        sizes = np.zeros(shape=(len(self), 3), dtype=np.float)
-        centers = np.zeros(shape=(len(self), 3), dtype=np.float)
+        sizes = np.zeros(shape=(len(self), 3), dtype=np.float32)
+        centers = np.zeros(shape=(len(self), 3), dtype=np.float32)
 
         for item_pos, _ in enumerate(self.indices):
             item_nodules = nodules[nodules.patient_pos == item_pos]
@@ -1387,7 +1594,7 @@ class CTImagesMaskedBatch(CTImagesBatch):
         else:
             raise ValueError('mode must be sum, max or none but {} was given'.format(mode))
 
-        permutation = np.random.permutation(len(self.upper_bounds))
+        permutation = RNG.permutation(len(self.upper_bounds))
         new_images, new_masks = mix_images_numba(self.images, self.masks,
                                                  self.upper_bounds, permutation, p, mode, mix_masks)
         setattr(self, 'images', new_images)
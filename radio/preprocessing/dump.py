@@ -3,6 +3,8 @@
 """ Auxiliarry async functions for encoding and dump of data """
 
 import os
+import asyncio
+from functools import partial
 import dill as pickle
 
 import numpy as np
@@ -13,6 +15,30 @@ from sklearn.cluster import MiniBatchKMeans
 KMEANS_MINIBATCH = 10000
 KMEANS_ITERS = 5
 
+def pack_array_nogil(array, **kwargs):
+    """ blosc-pack an ndarray, releasing the GIL while compressing.
+
+    Parameters
+    ----------
+    array : ndarray
+        array to pack.
+    **kwargs
+        passed to `blosc.pack_array`.
+
+    Returns
+    -------
+    bytes
+
+    Notes
+    -----
+    Previous (process-wide) releasegil-setting of blosc is restored afterwards.
+    """
+    releasegil = blosc.set_releasegil(True)
+    try:
+        return blosc.pack_array(array, **kwargs)
+    finally:
+        blosc.set_releasegil(releasegil)
+
 def get_linear(from_interval, to_interval):
     """ Get linear transformation that maps one interval to another
 
@@ -42,7 +68,7 @@ def get_linear(from_interval, to_interval):
 
     return linear
 
-async def encode_dump_array(data, folder, filename, mode):
+async def encode_dump_array(data, folder, filename, mode, cname='lz4', clevel=5):
     """ Encode an ndarray to int8, blosc-pack it and dump data along with
     the decoder and shape of data into supplied folder.
 
@@ -57,9 +83,14 @@ async def encode_dump_array(data, folder, filename, mode):
     mode : str or None
         Mode of encoding to int8. Can be either 'quantization' or 'linear'
         or None
+    cname : str
+        blosc compressor, e.g. 'lz4' (fast) or 'zstd' (better compression ratio).
+    clevel : int
+        blosc compression level from 0 to 9.
 
     Notes
     -----
+    blosc-packing is performed in the default executor (thread pool) of the event loop.
     currently, two modes of encoding are supported:
      - 'linear': maps linearly data-range to int8-range and then rounds off fractional part.
      - 'quantization': attempts to use histogram of pixel densities to come up with a
@@ -121,7 +152,11 @@ async def encode_dump_array(data, folder, filename, mode):
         raise ValueError('Unknown mode of int8-encoding')
 
     # serialize (possibly) encoded data and its shape
-    byted.extend([blosc.pack_array(encoded, cname='zstd', clevel=1), pickle.dumps(np.array(data.shape))])
+    # byte-shuffle groups bytes of the same significance, which compresses well for CT data;
+    # compression runs in executor with the GIL released, so that it does not block the event loop
+    pack = partial(pack_array_nogil, encoded, clevel=clevel, shuffle=blosc.SHUFFLE, cname=cname)
+    packed = await asyncio.get_event_loop().run_in_executor(None, pack)
+    byted.extend([packed, pickle.dumps(np.array(data.shape))])
     fnames.extend([filename, fname_noext + '.shape'])
 
     # dump serialized items
@@ -129,7 +164,7 @@ async def encode_dump_array(data, folder, filename, mode):
         async with aiofiles.open(os.path.join(folder, fname), mode='wb') as file:
             _ = await file.write(btd)
 
-async def dump_data(data_items, folder, i8_encoding_mode):
+async def dump_data(data_items, folder, i8_encoding_mode, cname='lz4', clevel=5):
     """ Dump data from data_items on disk in specified folder
 
     Parameters
@@ -142,6 +177,10 @@ async def dump_data(data_items, folder, i8_encoding_mode):
         inside the supplied folder.
     i8_encoding_mode: str, int, or dict
         contains mode of encoding to int8
+    cname : str
+        blosc compressor for blosc-packed items.
+    clevel : int
+        blosc compression level for blosc-packed items.
 
     Notes
     -----
@@ -164,7 +203,7 @@ async def dump_data(data_items, folder, i8_encoding_mode):
             else:
                 mode = i8_encoding_mode
 
-            _ = await encode_dump_array(data, item_folder, 'data.blk', mode)
+            _ = await encode_dump_array(data, item_folder, 'data.blk', mode, cname, clevel)
 
         elif ext == 'pkl':
             byted = pickle.dumps(data)
@@ -91,6 +91,47 @@ def insert_cropped(where, what, origin):
                                             st_what[2]: end_what[2]]
 
 
+@njit(nogil=True)
+def get_nodules_pixel_bounds_numba(centers, origin, spacing, sizes, scale, round_separately):
+    """ Compute start voxels and sizes in voxels of nodules in one pass.
+
+    Parameters
+    ----------
+    centers : ndarray(n, 3)
+        centers of nodules in world coords.
+    origin : ndarray(n, 3)
+        origins of scans which correspond to nodules.
+    spacing : ndarray(n, 3)
+        spacings of scans which correspond to nodules.
+    sizes : ndarray(n, 3)
+        sizes of nodules along (z,y,x) in world coords.
+    scale : ndarray(3,)
+        scale factor along (z,y,x) applied to voxel coords,
+        e.g. ones for masks of the same shape as scans.
+    round_separately : bool
+        if True, start is rint(center) - rint(size / 2), i.e. nodule is aligned
+        with its rounded center voxel. Otherwise, start is rint(center - size / 2).
+
+    Returns
+    -------
+    tuple
+        (start, size) of ndarrays(n, 3) of int64, size is rint(size); both in voxels.
+    """
+    n_nodules = centers.shape[0]
+    start = np.empty((n_nodules, 3), dtype=np.int64)
+    size = np.empty((n_nodules, 3), dtype=np.int64)
+    for i in range(n_nodules):
+        for j in range(3):
+            center_pix = np.abs(centers[i, j] - origin[i, j]) / spacing[i, j] * scale[j]
+            size_pix = sizes[i, j] / spacing[i, j] * scale[j]
+            if round_separately:
+                start[i, j] = np.int64(np.rint(center_pix) - np.rint(size_pix / 2))
+            else:
+                start[i, j] = np.int64(np.rint(center_pix - size_pix / 2))
+            size[i, j] = np.int64(np.rint(size_pix))
+    return start, size
+
+
 @njit(nogil=True)
 def make_rect_mask_numba(batch_mask, start, end, nodules_start, nodules_size):
     """ Make mask using information about nodules location and sizes.
@@ -102,6 +143,7 @@ def make_rect_mask_numba(batch_mask, start, end, nodules_start, nodules_size):
     ----------
     batch_mask : ndarray
         `masks` from batch, just initialised (filled with zeroes).
+        Can be of any numeric dtype, e.g. uint8.
     start : ndarray
         for each nodule, start position of patient in `skyscraper` is given
         by (nodule_index, z_start, y_start, x_start)
@@ -121,7 +163,7 @@ def make_rect_mask_numba(batch_mask, start, end, nodules_start, nodules_size):
 
         nodule = np.ones((int(nodule_size[0]),
                           int(nodule_size[1]),
-                          int(nodule_size[2])))
+                          int(nodule_size[2])), dtype=batch_mask.dtype)
 
         patient_mask = batch_mask[start[i, 0]: end[i, 0],
                                   start[i, 1]: end[i, 1],
@@ -0,0 +1,96 @@
+""" Container for info about nodules, used by CTImagesMaskedBatch. """
+
+import numpy as np
+
+
+class NodulesInfo:
+    """ Info about nodules stored as a set of separate contiguous ndarrays.
+
+    Each field is a standalone ndarray, first dimension of which enumerates
+    nodules (struct of arrays). Supports indexing by slices, integer
+    and boolean arrays in the same way as record arrays do.
+
+    Parameters
+    ----------
+    num_nodules : int
+        number of nodules. Used for filling fields, that are not supplied, with zeroes.
+    **kwargs
+        initial values of fields.
+
+    Attributes
+    ----------
+    patient_pos : ndarray(num_nodules, ) of int64
+        positions of patients which correspond to nodules.
+    offset : ndarray(num_nodules, 3) of int64
+        positions of patients' scans inside batch `skyscraper`.
+    img_size : ndarray(num_nodules, 3) of int64
+        sizes of images of patients which correspond to nodules.
+    nodule_center : ndarray(num_nodules, 3) of float32
+        centers of nodules in world coords.
+    nodule_size : ndarray(num_nodules, 3) of float32
+        sizes of nodules along z, y, x in world coords.
+    spacing : ndarray(num_nodules, 3) of float32
+        spacing of patients which correspond to nodules.
+    origin : ndarray(num_nodules, 3) of float32
+        origin of patients which correspond to nodules.
+    """
+
+    fields = (('patient_pos', np.int64, ()),
+              ('offset', np.int64, (3, )),
+              ('img_size', np.int64, (3, )),
+              ('nodule_center', np.float32, (3, )),
+              ('nodule_size', np.float32, (3, )),
+              ('spacing', np.float32, (3, )),
+              ('origin', np.float32, (3, )))
+
+    def __init__(self, num_nodules=0, **kwargs):
+        for name, dtype, shape in self.fields:
+            if name in kwargs:
+                value = np.ascontiguousarray(kwargs[name], dtype=dtype).reshape(-1, *shape)
+            else:
+                value = np.zeros((num_nodules, *shape), dtype=dtype)
+            setattr(self, name, value)
+
+    @classmethod
+    def from_records(cls, records):
+        """ Make NodulesInfo from record array (or another NodulesInfo) with the same fields.
+
+        Parameters
+        ----------
+        records : np.recarray or NodulesInfo
+            info about nodules.
+
+        Returns
+        -------
+        NodulesInfo
+        """
+        if isinstance(records, cls):
+            return records
+        return cls(**{name: getattr(records, name) for name, _, _ in cls.fields})
+
+    @classmethod
+    def concatenate(cls, nodules_list):
+        """ Concatenate sequence of NodulesInfo along nodules.
+
+        Parameters
+        ----------
+        nodules_list : list or tuple of NodulesInfo
+            info about nodules to concatenate.
+
+        Returns
+        -------
+        NodulesInfo
+        """
+        return cls(**{name: np.concatenate([getattr(nodules, name) for nodules in nodules_list])
+                      for name, _, _ in cls.fields})
+
+    @property
+    def shape(self):
+        """ Shape of info, i.e. (num_nodules, ). """
+        return self.patient_pos.shape
+
+    def __len__(self):
+        return self.patient_pos.shape[0]
+
+    def __getitem__(self, key):
+        return type(self)(**{name: getattr(self, name)[key] for name, _, _ in self.fields})
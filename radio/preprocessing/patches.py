@@ -1,10 +1,311 @@
 """ Auxiliary jit-decorated functions for splitting/assembling arrays into/from patches """
 
+from itertools import islice
+
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from numba import njit, prange
 
-@njit(parallel=True)
-def get_patches_numba(images, shape, stride, out):
+
+def get_patches_view(images, shape, stride, copy=False):
+    """ Get all patches from array of padded 3D scans as a strided view, without copying.
+
+    Parameters
+    ----------
+    images : ndarray
+        4darray, array of 3d-scans. Should be C-contiguous.
+        assumes scans are already padded.
+    shape : tuple, list or ndarray of int
+        shape of patch (z,y,x).
+    stride : tuple, list or ndarray of int
+        strides of a patch along (z,y,x).
+        (if not equal to patch_shape, patches will overlap).
+    copy : bool
+        if True, patches are copied into contiguous 4darray, first dimension of
+        which enumerates patches of all scans (same order as in `get_patches_numba`).
+        Use it when patches are going to be modified.
+
+    Returns
+    -------
+    ndarray
+        read-only 7darray-view of shape (num_scans, nz, ny, nx, *shape),
+        where nz, ny, nx are numbers of patches along (z,y,x), if `copy` is False.
+        Otherwise, 4darray of shape (num_scans * nz * ny * nx, *shape).
+
+    Raises
+    ------
+    ValueError
+        if `images` is not C-contiguous.
+    """
+    if not images.flags.c_contiguous:
+        raise ValueError('Patches view can be made only from C-contiguous array of scans')
+
+    shape, stride = _shape_key(shape), _shape_key(stride)
+
+    # compute number of patches along all axes
+    num_sections = tuple((size - patch) // step + 1
+                         for size, patch, step in zip(images.shape[1:], shape, stride))
+
+    scan_strides = images.strides[1:]
+    view = as_strided(images, shape=(images.shape[0], *num_sections, *shape),
+                      strides=(images.strides[0],
+                               *(step * bytes_step for step, bytes_step in zip(stride, scan_strides)),
+                               *scan_strides),
+                      writeable=False)
+
+    if copy:
+        return np.ascontiguousarray(view.reshape(-1, *shape))
+    return view
+
+
+def aligned_empty(shape, dtype, align=64):
+    """ Allocate uninitialized C-contiguous array, data of which starts at `align`-bytes boundary.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of array.
+    dtype : numpy dtype
+        dtype of array.
+    align : int
+        alignment in bytes, e.g. 64 for cache lines and AVX-512 stores.
+
+    Returns
+    -------
+    ndarray
+
+    Notes
+    -----
+    Memory is over-allocated by `align` bytes and the array is sliced from aligned offset.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -raw.ctypes.data % align
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+class PatchBufferPool:
+    """ Pool of reusable arrays for patches, so that arrays are not allocated for each batch.
+
+    Examples
+    --------
+        pool = PatchBufferPool()
+        for batch in pipeline:
+            buffer = pool.get(shape, np.float32)
+            patches = batch.get_patches(patch_shape, stride, out=buffer)
+            ...
+            pool.release(buffer)
+    """
+    def __init__(self):
+        self._free = {}
+
+    def get(self, shape, dtype):
+        """ Get free array of given shape and dtype, allocate new one if there is no such.
+
+        Parameters
+        ----------
+        shape : tuple
+            shape of array.
+        dtype : numpy dtype
+            dtype of array.
+
+        Returns
+        -------
+        ndarray
+            uninitialized C-contiguous array, aligned on 64 bytes.
+        """
+        key = (tuple(shape), np.dtype(dtype))
+        free = self._free.get(key)
+        if free:
+            return free.pop()
+        return aligned_empty(shape, dtype)
+
+    def release(self, buffer):
+        """ Return array to the pool, so that it can be given by `get` again.
+
+        Parameters
+        ----------
+        buffer : ndarray
+            array, previously obtained from `get`. Should not be used after release.
+        """
+        self._free.setdefault((buffer.shape, buffer.dtype), []).append(buffer)
+
+    def clear(self):
+        """ Drop all free arrays. """
+        self._free.clear()
+
+
+def iter_patches(images, shape, stride):
+    """ Iterate over patches of array of padded 3D scans without copying them.
+
+    Parameters
+    ----------
+    images : ndarray
+        4darray, array of 3d-scans. Should be C-contiguous.
+        assumes scans are already padded.
+    shape : tuple, list or ndarray of int
+        shape of patch (z,y,x).
+    stride : tuple, list or ndarray of int
+        strides of a patch along (z,y,x).
+
+    Yields
+    ------
+    ndarray
+        read-only 3darray-view of a patch. Patches go in the same order
+        as in `get_patches_numba`.
+    """
+    view = get_patches_view(images, shape, stride)
+    for it in range(view.shape[0]):
+        for ix in range(view.shape[1]):
+            for iy in range(view.shape[2]):
+                for iz in range(view.shape[3]):
+                    yield view[it, ix, iy, iz]
+
+
+def iter_patch_batches(images, shape, stride, batch_size, dtype=np.float32):
+    """ Iterate over batches of patches of array of padded 3D scans.
+
+    Parameters
+    ----------
+    images : ndarray
+        4darray, array of 3d-scans. Should be C-contiguous.
+        assumes scans are already padded.
+    shape : tuple, list or ndarray of int
+        shape of patch (z,y,x).
+    stride : tuple, list or ndarray of int
+        strides of a patch along (z,y,x).
+    batch_size : int
+        number of patches in a batch. The last batch can be smaller.
+    dtype : numpy dtype
+        dtype of batches.
+
+    Yields
+    ------
+    ndarray
+        contiguous 4darray of shape (batch_size, *shape), first dimension enumerates patches.
+
+    Notes
+    -----
+    Only one batch of patches is in memory at a time, which allows
+    to run sliding-window inference on scans, all patches of which do not fit into memory.
+    """
+    patches = iter_patches(images, shape, stride)
+    while True:
+        views = list(islice(patches, batch_size))
+        if not views:
+            return
+        batch = np.empty((len(views), *views[0].shape), dtype=dtype)
+        for i, patch in enumerate(views):
+            batch[i] = patch
+        yield batch
+
+
+def _shape_key(shape):
+    """ Cast (z,y,x)-shape given as tuple, list or ndarray to tuple of python ints.
+
+    Kernels get shapes and strides as python ints (compile-time constants
+    or int64-scalars), not as arrays, so no arrays are made on each call.
+    """
+    return tuple(int(size) for size in np.asarray(shape).ravel())
+
+
+def _check_clip_bounds(lo, hi):
+    """ Check that bounds of clipping are either both None or both set with lo < hi. """
+    if (lo is None) != (hi is None):
+        raise ValueError("Bounds of clipping 'lo' and 'hi' should be both None or both set, "
+                         "got lo={}, hi={}".format(lo, hi))
+    if lo is not None and not lo < hi:
+        raise ValueError("Lower bound of clipping 'lo' should be less than upper bound 'hi', "
+                         "got lo={}, hi={}".format(lo, hi))
+
+
+_GET_PATCHES_KERNELS = {}
+
+def make_get_patches_numba(shape, stride, normalize=False):
+    """ Make jit-compiled function for getting patches of fixed shape with fixed stride.
+
+    Parameters
+    ----------
+    shape : tuple, list or ndarray of int
+        shape of patch (z,y,x).
+    stride : tuple, list or ndarray of int
+        strides of a patch along (z,y,x).
+    normalize : bool
+        whether values are clipped and scaled while copying.
+
+    Returns
+    -------
+    callable
+        function `(images, out)` or `(images, out, lo, hi)` if `normalize` is True,
+        see `get_patches_numba` for description of args.
+
+    Notes
+    -----
+    `shape` and `stride` are baked into the function as compile-time constants,
+    so that numba can unroll and vectorize copying of patches. Functions are compiled
+    without bounds checks and with numpy error model, i.e. without branches on zero division. Functions are cached
+    by (shape, stride, normalize), while numba itself specializes them on dtypes of args.
+    """
+    key = (_shape_key(shape), _shape_key(stride), normalize)
+    if key in _GET_PATCHES_KERNELS:
+        return _GET_PATCHES_KERNELS[key]
+
+    (pz, py, px), (sz, sy, sx), _ = key
+
+    if normalize:
+        @njit(parallel=True, fastmath=True, boundscheck=False, error_model='numpy')
+        def get_normalized_patches_kernel(images, out, lo, hi):
+            """ Get all patches from array of padded 3D scans, clip them to [lo, hi],
+            scale to [0, 1] and put into out in one pass.
+            """
+            num_sections = ((images.shape[1] - pz) // sz + 1,
+                            (images.shape[2] - py) // sy + 1,
+                            (images.shape[3] - px) // sx + 1)
+            patches_per_slab = num_sections[1] * num_sections[2]
+            num_patches = num_sections[0] * patches_per_slab
+            scale = 1.0 / (hi - lo)
+
+            for i in prange(images.shape[0] * num_patches):             # pylint: disable=not-an-iterable
+                it, ctr = i // num_patches, i % num_patches
+                ix = ctr // patches_per_slab
+                rem = ctr - ix * patches_per_slab
+                iy = rem // num_sections[2]
+                iz = rem - iy * num_sections[2]
+                for x in range(pz):
+                    for y in range(py):
+                        for z in range(px):
+                            value = images[it, ix * sz + x, iy * sy + y, iz * sx + z]
+                            out[it, ctr, x, y, z] = (min(max(value, lo), hi) - lo) * scale
+
+        _GET_PATCHES_KERNELS[key] = get_normalized_patches_kernel
+        return get_normalized_patches_kernel
+
+    @njit(parallel=True, boundscheck=False, error_model='numpy')
+    def get_patches_kernel(images, out):
+        """ Get all patches from array of padded 3D scans, put them into out. """
+        # compute number of patches along all axes
+        num_sections = ((images.shape[1] - pz) // sz + 1,
+                        (images.shape[2] - py) // sy + 1,
+                        (images.shape[3] - px) // sx + 1)
+        patches_per_slab = num_sections[1] * num_sections[2]
+        num_patches = num_sections[0] * patches_per_slab
+
+        # iterate over all patches of all scans in one flat parallel loop, put them into out;
+        # consecutive patches, given to one thread, lie in the same slab along x
+        for i in prange(images.shape[0] * num_patches):                 # pylint: disable=not-an-iterable
+            it, ctr = i // num_patches, i % num_patches
+            ix = ctr // patches_per_slab
+            rem = ctr - ix * patches_per_slab
+            iy = rem // num_sections[2]
+            iz = rem - iy * num_sections[2]
+            out[it, ctr, :, :, :] = images[it, ix * sz:ix * sz + pz, iy * sy:iy * sy + py,
+                                           iz * sx:iz * sx + px]
+
+    _GET_PATCHES_KERNELS[key] = get_patches_kernel
+    return get_patches_kernel
+
+def get_patches_numba(images, shape, stride, out, lo=None, hi=None):
     """ Get all patches from array of padded 3D scans, put them into out.
 
     Parameters
@@ -12,36 +313,193 @@ def get_patches_numba(images, shape, stride, out):
     images : ndarray
         4darray, array of 3d-scans.
         assumes scans are already padded.
-    shape : ndarray
-        3D array with shape of patch (z,y,x).
-    stride : ndarray
-        3D array with strides of a patch along (z,y,x).
+    shape : tuple, list or ndarray of int
+        shape of patch (z,y,x).
+    stride : tuple, list or ndarray of int
+        strides of a patch along (z,y,x).
         (if not equal to patch_shape, patches will overlap).
     out : ndarray
         resulting 5d-array, where all patches are put. The first dimension enumerates scans,
-        while the second one enumerates patches.
+        while the second one enumerates patches. Can be of dtype different from
+        `images`, e.g. float32 for int16-scans; values are cast on the fly.
+    lo : float or None
+        if not None, values of patches are clipped to [lo, hi] and scaled to [0, 1]
+        while copying, e.g. lo=-1000, hi=400 for HU. Otherwise, values are copied as is.
+    hi : float or None
+        upper bound of clipping. Should be set if and only if `lo` is set, and be greater than `lo`.
+
+    Notes
+    -----
+    Uses function compiled for given `shape` and `stride` (see `make_get_patches_numba`).
     """
+    _check_clip_bounds(lo, hi)
+    if lo is None:
+        make_get_patches_numba(shape, stride)(images, out)
+    else:
+        make_get_patches_numba(shape, stride, normalize=True)(images, out, lo, hi)
 
-    # for convenience put scan-shape in ndarray
-    image_shape = np.zeros(3)
-    image_shape[:] = images.shape[1:]
+def extract_patches(images, shape, stride, out, lo=None, hi=None):
+    """ Get all patches from array of padded 3D scans, put them into out.
+
+    Parameters
+    ----------
+    images : ndarray
+        4darray, array of 3d-scans.
+        assumes scans are already padded.
+    shape : tuple, list or ndarray of int
+        shape of patch (z,y,x).
+    stride : tuple, list or ndarray of int
+        strides of a patch along (z,y,x).
+        (if not equal to patch_shape, patches will overlap).
+    out : ndarray
+        resulting 5d-array, where all patches are put. The first dimension enumerates scans,
+        while the second one enumerates patches. Values are cast to its dtype as in numpy
+        unsafe casting, e.g. floats are truncated for integer `out`.
+    lo : float or None
+        if not None, patches are clipped to [lo, hi] and scaled to [0, 1] while copying.
+    hi : float or None
+        upper bound of clipping. Should be set if and only if `lo` is set, and be greater than `lo`.
+
+    Notes
+    -----
+    When patches span the whole scans along x, every row of a patch (or
+    the whole patch, if patches span scans along y too) is a contiguous chunk
+    of `images`. In this case patches are put into out by a single numpy-copy
+    from strided view, that is done by contiguous memcpy-like runs.
+    Otherwise, or if normalization is required, `get_patches_numba` is used.
+    """
+    _check_clip_bounds(lo, hi)
+    shape, stride = _shape_key(shape), _shape_key(stride)
+    if (lo is None and shape[2] == images.shape[3] and images.flags.c_contiguous
+            and out.flags.c_contiguous):
+        view = get_patches_view(images, shape, stride)
+        np.copyto(out.reshape(view.shape), view, casting='unsafe')
+    else:
+        get_patches_numba(images, shape, stride, out, lo, hi)
+
+@njit(nogil=True, cache=True)
+def covering_patches_numba(size, patch_size, stride):
+    """ Compute ranges of indices of patches covering each voxel along one axis.
+
+    Parameters
+    ----------
+    size : int
+        size of scan along the axis.
+    patch_size : int
+        size of patch along the axis.
+    stride : int
+        stride of patches along the axis.
+
+    Returns
+    -------
+    tuple
+        (first, end) of 1darrays of length `size`, voxel p is covered
+        by patches with indices from first[p] to end[p] (exclusive).
+
+    Notes
+    -----
+    Voxel p is covered by patches with indices from ceil((p - patch_size + 1) / stride)
+    to floor(p / stride), clipped to the range of patch indices.
+    """
+    last_patch = (size - patch_size) // stride
+    first = np.empty(size, dtype=np.int64)
+    end = np.empty(size, dtype=np.int64)
+    for p in range(size):
+        first[p] = max(-((patch_size - 1 - p) // stride), 0)
+        end[p] = max(min(p // stride, last_patch) + 1, first[p])
+    return first, end
+
+_ASSEMBLE_PATCHES_KERNELS = {}
+
+def make_assemble_patches_numba(shape, stride):
+    """ Make jit-compiled function for assembling patches of fixed shape, extracted with fixed stride.
+
+    Parameters
+    ----------
+    shape : tuple, list or ndarray of int
+        shape of patch (z,y,x).
+    stride : tuple, list or ndarray of int
+        stride to extract patches in (z,y,x) dims.
+
+    Returns
+    -------
+    callable
+        function `(patches, out)`, see `assemble_patches_numba` for description of args.
+
+    Notes
+    -----
+    Same as `make_get_patches_numba`, `shape` and `stride` are compile-time constants.
+    """
+    key = (_shape_key(shape), _shape_key(stride))
+    if key in _ASSEMBLE_PATCHES_KERNELS:
+        return _ASSEMBLE_PATCHES_KERNELS[key]
+
+    (pz, py, px), (sz, sy, sx) = key
+
+    # fast-math flags allow reassociating the sum and multiplying by reciprocals in simd;
+    # nnan/ninf are left out, as voxels not covered by patches get nan
+    @njit(parallel=True, fastmath={'arcp', 'contract', 'reassoc'}, boundscheck=False, error_model='numpy')
+    def assemble_patches_kernel(patches, out):
+        """ Assemble overlapping patches into a set of 3d ct-scans, put the scans into out. """
+        # compute the number of sections
+        num_sections = ((out.shape[1] - pz) // sz + 1,
+                        (out.shape[2] - py) // sy + 1,
+                        (out.shape[3] - px) // sx + 1)
+
+        # ranges of patches covering voxels along each axis
+        first_x, end_x = covering_patches_numba(out.shape[1], pz, sz)
+        first_y, end_y = covering_patches_numba(out.shape[2], py, sy)
+        first_z, end_z = covering_patches_numba(out.shape[3], px, sx)
+
+        # inverse weights of voxels along each axis
+        inv_weights_x = 1.0 / (end_x - first_x)
+        inv_weights_y = 1.0 / (end_y - first_y)
+        inv_weights_z = 1.0 / (end_z - first_z)
+
+        # each voxel gathers values from patches covering it, so that threads
+        # only read patches and never write to the same voxels; the flat parallel
+        # loop runs over planes along x of all scans
+        for i in prange(out.shape[0] * out.shape[1]):                   # pylint: disable=not-an-iterable
+            it, x = i // out.shape[1], i % out.shape[1]
+            for y in range(out.shape[2]):
+                inv_weight_xy = inv_weights_x[x] * inv_weights_y[y]
+                for z in range(out.shape[3]):
+                    value = 0.0
+                    for ix in range(first_x[x], end_x[x]):
+                        for iy in range(first_y[y], end_y[y]):
+                            ctr = (ix * num_sections[1] + iy) * num_sections[2]
+                            for iz in range(first_z[z], end_z[z]):
+                                value += patches[it, ctr + iz, x - ix * sz, y - iy * sy, z - iz * sx]
+                    out[it, x, y, z] = value * inv_weight_xy * inv_weights_z[z]
+
+    _ASSEMBLE_PATCHES_KERNELS[key] = assemble_patches_kernel
+    return assemble_patches_kernel
+
+def assemble_patches_numba(patches, stride, out):
+    """ Assemble overlapping patches into a set of 3d ct-scans, put the scans into out.
+
+    Parameters
+    ----------
+    patches : ndarray
+        5d array of patches. First dim enumerates scans, while the second
+        enumerates patches; other dims are spatial with order (z,y,x).
+    stride : tuple, list or ndarray of int
+        stride to extract patches in (z,y,x) dims.
+    out : ndarray
+        4d-array, where assembled scans are put. First dim enumerates
+        scans. All its values are overwritten, so it need not be initialized.
+
+    Notes
+    -----
+    `out` should be of floating dtype, e.g. float32, while `patches`
+    can be of any numeric dtype; values are cast on the fly.
+    Each voxel gathers values from patches covering it and averages them.
+    Weights of voxels are computed as outer product of 1d-counts of
+    patches, overlapping along each axis, as patches form a regular grid.
+    Uses function compiled for given patch shape and `stride` (see `make_assemble_patches_numba`).
+    """
+    make_assemble_patches_numba(patches.shape[2:], stride)(patches, out)
 
-    # compute number of patches along all axes
-    num_sections = (image_shape - shape) // stride + 1
-
-    # iterate over patches, put them into out
-    for it in prange(images.shape[0]):                                     # pylint: disable=not-an-iterable
-        ctr = 0
-        for ix in range(int(num_sections[0])):
-            for iy in range(int(num_sections[1])):
-                for iz in range(int(num_sections[2])):
-                    inds = np.array([ix, iy, iz])
-                    lx, ly, lz = inds * stride
-                    ux, uy, uz = inds * stride + shape
-                    out[it, ctr, :, :, :] = images[it, lx:ux, ly:uy, lz:uz]
-                    ctr += 1
-
-@njit(parallel=True)
 def assemble_patches(patches, stride, out):
     """ Assemble patches into a set of 3d ct-scans with shape scan_shape,
     put the scans into out.
@@ -51,11 +509,11 @@ def assemble_patches(patches, stride, out):
     patches : ndarray
         5d array of patches. First dim enumerates scans, while the second
         enumerates patches; other dims are spatial with order (z,y,x).
-    stride : ndarray
+    stride : tuple, list or ndarray of int
         stride to extract patches in (z,y,x) dims.
     out : ndarray
         4d-array, where assembled scans are put. First dim enumerates
-        scans. Should be filled with zeroes before calling function.
+        scans. All its values are overwritten, so it need not be initialized.
 
     Notes
     -----
@@ -67,35 +525,20 @@ def assemble_patches(patches, stride, out):
     In this case pixel values are averaged across overlapping patches
     We assume that integer number of patches can be put into
     out using stride.
-
+    Non-overlapping patches, tiling the whole scans, are put into out
+    by a single reshape-transpose copy without computing weights.
     """
-    scan_shape = np.zeros(3)
-    scan_shape[:] = out.shape[1:]
-
-    # cast patch.shape to ndarray
-    patch_shape = np.zeros(3, dtype=np.int64)
-    patch_shape[:] = patches.shape[2:]
-
-    # compute the number of sections
-    num_sections = (scan_shape - patch_shape) // stride + 1
-
-    # iterate over scans and patches, put them into corresponding place in out
-    # increment pixel weight if it belongs to a patch
-    weights_inv = np.zeros_like(out)
-    for it in prange(out.shape[0]):                                     # pylint: disable=not-an-iterable
-        ctr = 0
-        for ix in range(int(num_sections[0])):
-            for iy in range(int(num_sections[1])):
-                for iz in range(int(num_sections[2])):
-                    inds = np.array([ix, iy, iz])
-                    lx, ly, lz = inds * stride
-                    ux, uy, uz = inds * stride + patch_shape
-                    out[it, lx:ux, ly:uy, lz:uz] += patches[it, ctr, :, :, :]
-                    weights_inv[it, lx:ux, ly:uy, lz:uz] += 1.0
-                    ctr += 1
-
-        # weight assembled image
-        out[it, ...] /= weights_inv[it]
+    stride, patch_shape = _shape_key(stride), patches.shape[2:]
+    scan_shape = out.shape[1:]
+
+    if (stride == patch_shape and all(size % patch == 0 for size, patch in zip(scan_shape, patch_shape))
+            and out.flags.c_contiguous):
+        num_sections = [size // patch for size, patch in zip(scan_shape, patch_shape)]
+        tiles = out.reshape(out.shape[0], num_sections[0], patch_shape[0], num_sections[1],
+                            patch_shape[1], num_sections[2], patch_shape[2])
+        tiles[...] = patches.reshape(out.shape[0], *num_sections, *patch_shape).transpose(0, 1, 4, 2, 5, 3, 6)
+    else:
+        assemble_patches_numba(patches, stride, out)
 
 def calc_padding_size(img_shape, patch_shape, stride):
     """ Calculate padding width to add to 3d-scan
@@ -0,0 +1,125 @@
+""" CUDA-kernels for splitting/assembling arrays of scans, stored on device, into/from patches
+
+The module is not imported by `radio.preprocessing`, so that importing radio does not
+touch CUDA. Import functions from it directly, e.g.
+`from radio.preprocessing.patches_cuda import get_patches_cuda, assemble_patches_cuda`,
+and pass device arrays (cupy or numba) of scans and patches.
+"""
+
+import math
+
+from numba import cuda
+
+from .patches import _shape_key
+
+
+THREADS_PER_BLOCK = 256
+
+
+@cuda.jit
+def _get_patches_kernel(images, pz, py, px, sz, sy, sx, out):
+    """ Put one voxel of one patch into out, thread per element of out. """
+    pos = cuda.grid(1)
+    if pos >= out.size:
+        return
+
+    # decompose flat position in out into (scan, patch, z, y, x) so that
+    # neighbouring threads write neighbouring elements of out
+    pos, z = pos // px, pos % px
+    pos, y = pos // py, pos % py
+    pos, x = pos // pz, pos % pz
+    it, ctr = pos // out.shape[1], pos % out.shape[1]
+
+    # decompose patch index into (ix, iy, iz)
+    num_sections_y = (images.shape[2] - py) // sy + 1
+    num_sections_z = (images.shape[3] - px) // sx + 1
+    ixy, iz = ctr // num_sections_z, ctr % num_sections_z
+    ix, iy = ixy // num_sections_y, ixy % num_sections_y
+
+    out[it, ctr, x, y, z] = images[it, ix * sz + x, iy * sy + y, iz * sx + z]
+
+
+@cuda.jit
+def _assemble_patches_kernel(patches, pz, py, px, sz, sy, sx, out):
+    """ Gather value of one voxel of out from patches covering it, thread per voxel. """
+    pos = cuda.grid(1)
+    if pos >= out.size:
+        return
+
+    pos, z = pos // out.shape[3], pos % out.shape[3]
+    pos, y = pos // out.shape[2], pos % out.shape[2]
+    it, x = pos // out.shape[1], pos % out.shape[1]
+
+    num_sections_x = (out.shape[1] - pz) // sz + 1
+    num_sections_y = (out.shape[2] - py) // sy + 1
+    num_sections_z = (out.shape[3] - px) // sx + 1
+
+    # ranges of patches covering the voxel along each axis
+    # (end is clipped by first, so that voxels not covered by patches get empty ranges)
+    first_x = max(-((pz - 1 - x) // sz), 0)
+    first_y = max(-((py - 1 - y) // sy), 0)
+    first_z = max(-((px - 1 - z) // sx), 0)
+    end_x = max(min(x // sz + 1, num_sections_x), first_x)
+    end_y = max(min(y // sy + 1, num_sections_y), first_y)
+    end_z = max(min(z // sx + 1, num_sections_z), first_z)
+
+    value = 0.0
+    for ix in range(first_x, end_x):
+        for iy in range(first_y, end_y):
+            ctr = (ix * num_sections_y + iy) * num_sections_z
+            for iz in range(first_z, end_z):
+                value += patches[it, ctr + iz, x - ix * sz, y - iy * sy, z - iz * sx]
+
+    # voxels not covered by patches get nan, same as in `assemble_patches_numba`
+    count = (end_x - first_x) * (end_y - first_y) * (end_z - first_z)
+    out[it, x, y, z] = value / count if count > 0 else math.nan
+
+
+def get_patches_cuda(images, shape, stride, out):
+    """ Get all patches from array of padded 3D scans on GPU, put them into out.
+
+    Parameters
+    ----------
+    images : device array
+        4darray, array of 3d-scans, e.g. cupy.ndarray or numba device array.
+        assumes scans are already padded.
+    shape : tuple, list or ndarray of int
+        shape of patch (z,y,x).
+    stride : tuple, list or ndarray of int
+        strides of a patch along (z,y,x).
+        (if not equal to patch_shape, patches will overlap).
+    out : device array
+        resulting 5d-array on the same device, where all patches are put. The first dimension
+        enumerates scans, while the second one enumerates patches.
+
+    Notes
+    -----
+    Arrays are not copied to host, so that patches can be fed to a model
+    without round trip through host memory, e.g. `get_patches_cuda(cp.asarray(images), ...)`.
+    """
+    num_blocks = (out.size + THREADS_PER_BLOCK - 1) // THREADS_PER_BLOCK
+    _get_patches_kernel[num_blocks, THREADS_PER_BLOCK](images, *_shape_key(shape), *_shape_key(stride), out)
+
+
+def assemble_patches_cuda(patches, stride, out):
+    """ Assemble patches on GPU into a set of 3d ct-scans, put the scans into out.
+
+    Parameters
+    ----------
+    patches : device array
+        5d array of patches, e.g. cupy.ndarray or numba device array. First dim enumerates scans,
+        while the second enumerates patches; other dims are spatial with order (z,y,x).
+    stride : tuple, list or ndarray of int
+        stride to extract patches in (z,y,x) dims.
+    out : device array
+        4d-array on the same device, where assembled scans are put. First dim enumerates
+        scans. All its values are overwritten.
+
+    Notes
+    -----
+    Each voxel gathers values from patches covering it and averages them,
+    same as in `assemble_patches_numba`. Voxels not covered by any patch get nan.
+    """
+    num_blocks = (out.size + THREADS_PER_BLOCK - 1) // THREADS_PER_BLOCK
+    _assemble_patches_kernel[num_blocks, THREADS_PER_BLOCK](patches, *_shape_key(patches.shape[2:]),
+                                                            *_shape_key(stride), out)